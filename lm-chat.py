@@ -2,49 +2,112 @@
 
 import argparse
 import cmd
-import itertools
+import functools
+import http.client
 import json
 import os
 import signal
 import sys
+import threading
 import time
-import urllib.error
-import urllib.request
+import urllib.parse
 
+try:
+    import orjson
 
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+
+# Only "data:" lines carrying a JSON object hold completion chunks, the JSON
+# payload starts at the "{"
+SSE_JSON_PREFIX = b"data: {"
+SSE_JSON_START = len(SSE_JSON_PREFIX) - 1
+
+SPINNER = ("⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏")
+
+
+# The terminal doesn't change during a session, only check it once
+@functools.lru_cache(maxsize=None)
 def should_colorize():
     t = os.getenv("TERM")
     return t and t != "dumb" and sys.stdout.isatty()
 
 
+def iter_line_batches(response, chunk_size=65536):
+    """
+    Yields the complete lines of a streamed response, one list per read.
+    Reads whatever is available with read1() and splits it locally, rather
+    than one readline() per SSE line.
+    """
+    buf = bytearray()
+    while True:
+        chunk = response.read1(chunk_size)
+        if not chunk:
+            break
+
+        buf += chunk
+        end = buf.rfind(b"\n")
+        if end == -1:
+            continue
+
+        lines = bytes(buf[:end]).split(b"\n")
+        del buf[: end + 1]
+        yield lines
+
+    if buf:
+        yield [bytes(buf)]
+
+
 def res(response, color):
-    color_default = ""
-    color_yellow = ""
+    # Tokens are written as UTF-8 straight to the binary buffer, skipping the
+    # text layer's encoder, so flush what print() has buffered first
+    print("\r", end="", flush=True)
+    out = sys.stdout.buffer
+    # Decide on colors once, so each token is a single write()
     if (color == "auto" and should_colorize()) or color == "always":
-        color_default = "\033[0m"
-        color_yellow = "\033[33m"
-
-    print("\r", end="")
-    assistant_response = ""
-    for line in response:
-        line = line.decode("utf-8").strip()
-        if line.startswith("data: {"):
-            choice = ""
-
-            json_line = json.loads(line[len("data: ") :])
-            if "choices" in json_line and json_line["choices"]:
-                choice = json_line["choices"][0]["delta"]
-            if "content" in choice:
-                choice = choice["content"]
-            else:
+
+        def emit(text):
+            out.write(b"\033[33m" + text.encode("utf-8") + b"\033[0m")
+
+    else:
+
+        def emit(text):
+            out.write(text.encode("utf-8"))
+
+    parts = []
+    for lines in iter_line_batches(response):
+        for line in lines:
+            # Check the raw bytes first, keepalives, comments and
+            # "data: [DONE]" never need to be decoded
+            if not line.startswith(SSE_JSON_PREFIX):
+                continue
+
+            json_line = json_loads(line[SSE_JSON_START:])
+            choices = json_line.get("choices")
+            if not choices:
+                continue
+
+            delta = choices[0].get("delta")
+            if not delta:
                 continue
 
+            choice = delta.get("content")
             if choice:
-                print(f"{color_yellow}{choice}{color_default}", end="", flush=True)
-                assistant_response += choice
+                emit(choice)
+                parts.append(choice)
+
+        # Flush once per read rather than per token, tokens that arrived
+        # together are written together and nothing waits on the next read
+        out.flush()
 
     print("")
-    return assistant_response
+    return "".join(parts)
 
 
 def add_api_key(args, headers=None):
@@ -61,14 +124,88 @@ def add_api_key(args, headers=None):
     return headers
 
 
+def connect(url):
+    """
+    Returns a connection to the server hosting url. http.client keeps the
+    connection alive, so it can be reused for every request to that server.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme == "https":
+        return http.client.HTTPSConnection(parts.netloc)
+
+    return http.client.HTTPConnection(parts.netloc)
+
+
+def send(conn, method, path, body=None, headers=None):
+    """
+    Sends a request on conn and returns the response. Raises on HTTP error
+    statuses, the same way urlopen() does.
+    """
+    conn.request(method, path, body=body, headers=headers or {})
+    response = conn.getresponse()
+    if response.status >= 400:
+        # Drain the body so the connection can be reused
+        response.read()
+        raise http.client.HTTPException(
+            f"HTTP Error {response.status}: {response.reason}"
+        )
+
+    return response
+
+
+class Spinner:
+    """
+    Animates SPINNER on a background thread while the block it wraps waits
+    on the server, so waiting never blocks on terminal writes.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._spin, daemon=True)
+
+    def _spin(self):
+        out = sys.stdout
+        # Only the glyph changes, after the first frame just step back over it
+        move = "\r"
+        frame = 0
+        while not self._stop.wait(0.1):
+            out.write(move + SPINNER[frame % len(SPINNER)])
+            out.flush()
+            move = "\b"
+            frame += 1
+
+    def __enter__(self):
+        if self.enabled:
+            self._thread.start()
+
+        return self
+
+    def __exit__(self, *exc):
+        if self.enabled:
+            self._stop.set()
+            self._thread.join()
+
+
 class LmChatShell(cmd.Cmd):
     def __init__(self, args):
         super().__init__()
         self.conversation_history = []
+        # Each message is serialized once, when it's added, rather than the
+        # whole history being re-encoded on every turn
+        self.serialized_history = []
         self.args = args
         self.request_in_process = False
         self.prompt = args.prefix
         self.url = f"{args.url}/chat/completions"
+        self.path = urllib.parse.urlsplit(self.url).path
+        self.conn = connect(self.url)
+        # Nothing in the headers changes between turns
+        self.headers = add_api_key(
+            args, {"Content-Type": "application/json"}
+        )
+        # run always has a model, so everything after the messages is fixed
+        self.request_suffix = b'],"model":' + json_dumps(args.model) + b"}"
 
     def handle_args(self):
         prompt = " ".join(self.args.ARGS) if self.args.ARGS else None
@@ -93,44 +230,31 @@ class LmChatShell(cmd.Cmd):
         if user_content in ["/bye", "exit"]:
             return True
 
-        self.conversation_history.append(
-            {"role": "user", "content": user_content}
-        )
+        self._add_message("user", user_content)
         self.request_in_process = True
         response = self._req()
         if not response:
             return True
 
-        self.conversation_history.append(
-            {"role": "assistant", "content": response}
-        )
+        self._add_message("assistant", response)
         self.request_in_process = False
 
+    def _add_message(self, role, content):
+        message = {"role": role, "content": content}
+        self.conversation_history.append(message)
+        self.serialized_history.append(json_dumps(message))
+
     def _make_request_data(self):
-        data = {
-            "stream": True,
-            "messages": self.conversation_history,
-        }
-        if self.args.model is not None:
-            data["model"] = self.args.model
-
-        json_data = json.dumps(data).encode("utf-8")
-        headers = {
-            "Content-Type": "application/json",
-        }
-
-        headers = add_api_key(self.args, headers)
-        request = urllib.request.Request(
-            self.url, data=json_data, headers=headers, method="POST"
+        return (
+            b'{"stream":true,"messages":['
+            + b",".join(self.serialized_history)
+            + self.request_suffix
         )
 
-        return request
-
     def _req(self):
-        request = self._make_request_data()
+        json_data = self._make_request_data()
 
         i = 0.01
-        total_time_slept = 0
         response = None
 
         # Adjust timeout based on whether we're in initial connection phase
@@ -138,23 +262,26 @@ class LmChatShell(cmd.Cmd):
             30 if getattr(self.args, "initial_connection", False) else 16
         )
 
-        for c in itertools.cycle(
-            ["⠋", "⠙", "⠹", "⠸", "⠼", "⠴", "⠦", "⠧", "⠇", "⠏"]
-        ):
-            try:
-                response = urllib.request.urlopen(request)
-                break
-            except Exception:
-                if sys.stdout.isatty():
-                    print(f"\r{c}", end="", flush=True)
-
-                if total_time_slept > max_timeout:
+        start = time.monotonic()
+        # The spinner covers both retries and a server that is slow to start
+        # responding
+        with Spinner(enabled=sys.stdout.isatty()):
+            while True:
+                try:
+                    response = send(
+                        self.conn, "POST", self.path, json_data, self.headers
+                    )
                     break
+                except (OSError, http.client.HTTPException):
+                    # Also covers a kept-alive connection the server has
+                    # since dropped, the next request opens a fresh one
+                    self.conn.close()
+                    if time.monotonic() - start > max_timeout:
+                        break
 
-                total_time_slept += i
-                time.sleep(i)
+                    time.sleep(i)
 
-                i = min(i * 2, 0.1)
+                    i = min(i * 2, 0.1)
 
         if response:
             return res(response, self.args.color)
@@ -167,6 +294,9 @@ class LmChatShell(cmd.Cmd):
 
         return None
 
+    def close(self):
+        self.conn.close()
+
     def loop(self):
         while True:
             self.request_in_process = False
@@ -174,6 +304,8 @@ class LmChatShell(cmd.Cmd):
                 self.cmdloop()
             except KeyboardInterrupt:
                 print("")
+                # A response interrupted mid-stream can't be reused
+                self.conn.close()
                 if not self.request_in_process:
                     print("Use Ctrl + d or /bye or exit to quit.")
 
@@ -194,31 +326,38 @@ def alarm_handler(signum, frame):
 
 
 def chat(args):
-    list_models = args.command == "list" or args.command == "ls"
-    if list_models:
+    if args.command == "list" or args.command == "ls":
         url = f"{args.url}/models"
         headers = add_api_key(args)
-        req = urllib.request.Request(url, headers=headers)
-        with urllib.request.urlopen(req) as response:
-            data = json.loads(response.read())
-            ids = [model["id"] for model in data.get("data", [])]
-            for idi in ids:
-                print(idi)
-    elif args.command != "run":
+        conn = connect(url)
+        try:
+            path = urllib.parse.urlsplit(url).path
+            with send(conn, "GET", path, headers=headers) as response:
+                data = json_loads(response.read())
+        finally:
+            conn.close()
+
+        ids = [model["id"] for model in data.get("data", [])]
+        for idi in ids:
+            print(idi)
+
+        return 0
+
+    if args.command != "run":
         return 1
 
+    shell = LmChatShell(args)
     try:
-        shell = LmChatShell(args)
-        if not list_models:
-            if shell.handle_args():
-                return 0
+        if shell.handle_args():
+            return 0
 
-            shell.loop()
+        shell.loop()
     except TimeoutException as e:
         print(f"Timeout Exception: {e}")
         # Handle the timeout, e.g., print a message and exit gracefully
         print("")
     finally:
+        shell.close()
         # Reset the alarm to 0 to cancel any pending alarms
         signal.alarm(0)
 